@@ -5,45 +5,183 @@
 # LICENSE file in the root directory of this source tree.
 
 import json
+import math
+import os
 import statistics
+import threading
+from collections import deque
 from pathlib import Path
-from typing import Dict, List
+from typing import Any, BinaryIO, Deque, Dict, List, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_loads(data: bytes) -> Any:
+    """Parse JSON, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj: Any, indent: bool = False) -> bytes:
+    """Serialize to JSON, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(obj, indent=2).encode()
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+# Number of locks the test cases are spread over in HistoricalTimes
+LOCK_STRIPES = 64
 
 
 class HistoricalTimes:
-    def __init__(self, file_path: str = "execution_history.json") -> None:
+    def __init__(
+        self, file_path: str = "execution_history.json", max_history: int = 64
+    ) -> None:
         self.file_path = file_path
-        self.execution_history: Dict[str, List[float]] = {}
+        # Only the most recent max_history times are kept per test case
+        self.max_history = max_history
+        # Append-only log of updates made since the last save, one JSON object
+        # per line. It is replayed on load and folded into file_path on save.
+        self.wal_path = file_path + ".wal"
+        # Bumped on every save and stamped on each log record, so records
+        # that are already part of file_path are skipped on replay
+        self._generation = 0
+        self.execution_history: Dict[str, Deque[float]] = {}
+        # Running totals per test case so mean and standard deviation do not
+        # have to walk the full history on every query.
+        self._sums: Dict[str, float] = {}
+        self._sums_sq: Dict[str, float] = {}
+        self._counts: Dict[str, int] = {}
+        # Updates for different test cases rarely share a lock, while the
+        # times and totals of any one test case stay consistent
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._wal: Optional[BinaryIO] = None
+        self._wal_lock = threading.Lock()
         self.load_execution_history()
 
     def load_execution_history(self) -> None:
-        """Load historical execution times from a JSON file."""
+        """Load historical execution times from a JSON file and its write-ahead log."""
         if Path(self.file_path).exists():
-            with open(self.file_path, "r") as file:
-                self.execution_history = json.load(file)
+            with open(self.file_path, "rb") as file:
+                data = _json_loads(file.read())
+            if isinstance(data.get("generation"), int):
+                self._generation = data["generation"]
+                data = data["execution_history"]
+            # Files written before generations were added hold the plain
+            # history and count as generation 0
+            for name, times in data.items():
+                for execution_time in times:
+                    self._add_time(name, execution_time)
+        if Path(self.wal_path).exists():
+            self._replay_wal()
+
+    def _replay_wal(self) -> None:
+        """Apply the log records that are not yet part of the JSON file."""
+        with open(self.wal_path, "rb") as file:
+            for line in file:
+                try:
+                    entry = _json_loads(line)
+                    name = str(entry["name"])
+                    execution_time = float(entry["t"])
+                    generation = int(entry.get("gen", 0))
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    # A partially written last line after an interrupted run,
+                    # or a corrupt record
+                    continue
+                if generation >= self._generation:
+                    self._add_time(name, execution_time)
 
     def save_execution_history(self) -> None:
-        """Save historical execution times to a JSON file."""
-        with open(self.file_path, "w") as file:
-            json.dump(self.execution_history, file, indent=4)
+        """Compact the write-ahead log into the JSON file and remove the log."""
+        with self._wal_lock:
+            if self._wal is not None:
+                self._wal.close()
+                self._wal = None
+            # Everything logged so far carries a generation below this one, so
+            # if the log cannot be removed after the swap it is not replayed
+            generation = self._generation + 1
+            tmp_path = self.file_path + ".tmp"
+            with open(tmp_path, "wb") as file:
+                history = {}
+                for name, times in list(self.execution_history.items()):
+                    with self._lock_for(name):
+                        history[name] = list(times)
+                data = {"generation": generation, "execution_history": history}
+                file.write(_json_dumps(data, indent=True))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.file_path)
+            self._generation = generation
+            if Path(self.wal_path).exists():
+                os.remove(self.wal_path)
 
     def update_historical_time(
         self, test_case_name: str, execution_time: float
     ) -> None:
         """Update the historical execution time for a test case."""
-        if test_case_name in self.execution_history:
-            self.execution_history[test_case_name].append(execution_time)
+        with self._lock_for(test_case_name):
+            self._add_time(test_case_name, execution_time)
+        with self._wal_lock:
+            record = _json_dumps(
+                {"name": test_case_name, "t": execution_time, "gen": self._generation}
+            )
+            if self._wal is None:
+                self._wal = open(self.wal_path, "ab")
+                if self._wal.tell():
+                    # Start on a fresh line in case the previous run was cut off
+                    self._wal.write(b"\n")
+            self._wal.write(record + b"\n")
+            # Hand each record to the OS right away so it survives the
+            # process being killed
+            self._wal.flush()
+
+    def _lock_for(self, test_case_name: str) -> threading.Lock:
+        """Get the lock guarding a test case's times and running totals."""
+        return self._locks[hash(test_case_name) % LOCK_STRIPES]
+
+    def _add_time(self, test_case_name: str, execution_time: float) -> None:
+        """Record an execution time and update the running totals."""
+        times = self.execution_history.get(test_case_name)
+        if times is not None:
+            if len(times) == times.maxlen:
+                # The oldest time is about to drop out of the ring buffer
+                oldest = times[0]
+                self._sums[test_case_name] -= oldest
+                self._sums_sq[test_case_name] -= oldest * oldest
+                self._counts[test_case_name] -= 1
+            times.append(execution_time)
+            self._sums[test_case_name] += execution_time
+            self._sums_sq[test_case_name] += execution_time * execution_time
+            self._counts[test_case_name] += 1
         else:
-            self.execution_history[test_case_name] = [execution_time]
+            self.execution_history[test_case_name] = deque(
+                [execution_time], maxlen=self.max_history
+            )
+            self._sums[test_case_name] = execution_time
+            self._sums_sq[test_case_name] = execution_time * execution_time
+            self._counts[test_case_name] = 1
 
     def get_execution_times(self, test_case_name: str) -> List[float]:
-        """Get all historical execution times for a test case."""
-        return self.execution_history.get(test_case_name, [])
+        """Get the retained historical execution times for a test case."""
+        with self._lock_for(test_case_name):
+            return list(self.execution_history.get(test_case_name, ()))
 
     def get_average_execution_time(self, test_case_name: str) -> float:
         """Calculate the average execution time for a test case."""
-        times = self.get_execution_times(test_case_name)
-        return statistics.mean(times) if times else 0.0
+        with self._lock_for(test_case_name):
+            count = self._counts.get(test_case_name, 0)
+            return self._sums[test_case_name] / count if count else 0.0
+
+    def get_global_average_execution_time(self) -> float:
+        """Calculate the average execution time across all test cases."""
+        count = sum(self._counts.values())
+        return sum(self._sums.values()) / count if count else 0.0
 
     def get_median_execution_time(self, test_case_name: str) -> float:
         """Calculate the median execution time for a test case."""
@@ -52,8 +190,16 @@ class HistoricalTimes:
 
     def get_standard_deviation(self, test_case_name: str) -> float:
         """Calculate the standard deviation of execution times for a test case."""
-        times = self.get_execution_times(test_case_name)
-        return statistics.stdev(times) if len(times) > 1 else 0.0
+        with self._lock_for(test_case_name):
+            count = self._counts.get(test_case_name, 0)
+            if count < 2:
+                return 0.0
+            total = self._sums[test_case_name]
+            total_sq = self._sums_sq[test_case_name]
+        mean = total / count
+        variance = (total_sq - count * mean * mean) / (count - 1)
+        # Guard against tiny negative values from floating point cancellation
+        return math.sqrt(max(0.0, variance))
 
     def get_all_test_cases(self) -> List[str]:
         """Get a list of all test cases with historical data."""
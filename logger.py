@@ -5,6 +5,12 @@
 # LICENSE file in the root directory of this source tree.
 
 import logging
+import os
+import sys
+
+# Only emit ANSI colors when logging to a terminal and NO_COLOR is not set
+# (https://no-color.org). CI logs and redirected output get plain text.
+USE_COLOR = sys.stderr.isatty() and not os.environ.get("NO_COLOR")
 
 
 class ColorFormatter(logging.Formatter):
@@ -29,10 +35,23 @@ class ColorFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format_str + reset + "%(message)s",
     }
 
+    def __init__(self, use_color: bool = USE_COLOR):
+        super().__init__()
+        # Build one formatter per level up front instead of one per record
+        self._formatters = {
+            level: logging.Formatter(
+                fmt if use_color else self.format_str + "%(message)s",
+                datefmt="%Y-%m-%d %H:%M:%S",
+            )
+            for level, fmt in self.FORMATS.items()
+        }
+
     def format(self, record):
-        # Get the appropriate format based on the log level
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt, datefmt="%Y-%m-%d %H:%M:%S")
+        # Get the appropriate formatter based on the log level
+        formatter = self._formatters.get(record.levelno)
+        if formatter is None:
+            # Custom levels fall back to the plain format, as before
+            formatter = logging.Formatter(datefmt="%Y-%m-%d %H:%M:%S")
         return formatter.format(record)
 
 
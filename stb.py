@@ -5,22 +5,31 @@
 # LICENSE file in the root directory of this source tree.
 
 import argparse
+import itertools
+import logging
+import os
+import shutil
 import subprocess
 import sys
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from queue import Queue
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import yaml
 
-from historical_times import HistoricalTimes
-from logger import logger
+from historical_times import HistoricalTimes, _json_dumps, _json_loads
+from logger import USE_COLOR, logger
 
 history = HistoricalTimes()
 
+# Exit code squishrunner is told to use when a test case fails
+FAIL_EXIT_CODE = 44
+# Options passed to squishrunner for every test case
+SQUISHRUNNER_OPTIONS = ("--exitCodeOnFail", str(FAIL_EXIT_CODE), "--reportgen", "null")
+
 
 @dataclass
 class SquishServer:
@@ -31,11 +40,27 @@ class SquishServer:
         return f"{self.host}:{self.port}"
 
 
+@dataclass(frozen=True)
 class TestCase:
-    def __init__(self, path: Path):
-        self.path = path
-        self.name = path.name
-        self.suite = path.parent
+    # No per-instance __dict__; test cases of one suite share its Path object
+    __slots__ = ("name", "suite")
+
+    name: str
+    suite: Path
+
+    @property
+    def path(self) -> Path:
+        return self.suite / self.name
+
+    # Frozen dataclasses with hand-written __slots__ cannot be copied or
+    # pickled without these (dataclass(slots=True) needs Python 3.10)
+    def __getstate__(self):
+        return (self.name, self.suite)
+
+    def __setstate__(self, state):
+        name, suite = state
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "suite", suite)
 
     def __str__(self):
         return f"TestCase(name={self.name}, suite={self.suite})"
@@ -54,25 +79,35 @@ class Config:
     def load_config(self, config_file: str):
         try:
             with open(config_file, "r") as file:
-                logger.debug(f"Loading config file: {config_file}")
+                logger.debug("Loading config file: %s", config_file)
                 self.config = yaml.safe_load(file)
                 # Load Squish servers
                 self._squish_servers = []
                 for server in self.config.get("squish_servers", []):
-                    logger.debug(f"Found server: {server}")
+                    logger.debug("Found server: %s", server)
                     host, port = server.split(":")
                     self._squish_servers.append(SquishServer(host, int(port)))
 
                 # Load squishrunner path
                 self._squishrunner_path = self.config.get("squishrunner_path")
-                logger.debug(f"Using squishrunner: {self.squishrunner_path}")
+                if self._squishrunner_path:
+                    # squishrunner is not started through a shell, so drop the
+                    # quotes paths with spaces used to need and expand "~" and
+                    # environment variables here instead
+                    path = self._squishrunner_path.strip()
+                    if len(path) > 1 and path[0] == path[-1] and path[0] in "\"'":
+                        path = path[1:-1]
+                    self._squishrunner_path = os.path.expanduser(
+                        os.path.expandvars(path)
+                    )
+                logger.debug("Using squishrunner: %s", self.squishrunner_path)
 
                 # Load test suites directory
                 self._test_suites_dir = self.config.get("test_suites_dir")
-                logger.debug(f"Test suites directory: {self.test_suites_dir}")
+                logger.debug("Test suites directory: %s", self.test_suites_dir)
 
         except Exception as e:
-            logger.error(f"Error loading config file {config_file}: {e}")
+            logger.error("Error loading config file %s: %s", config_file, e)
             sys.exit(1)
 
     @property
@@ -89,18 +124,31 @@ class Config:
 
 
 def run_squish_test(
-    test_case: TestCase, squish_server: SquishServer
+    test_case: TestCase, squish_server: SquishServer, squishrunner_path: str
 ) -> Tuple[str, bool, float]:
     try:
         start_time = time.time()
-        command = (
-            f"{Config().squishrunner_path} --host {squish_server.host} --port {squish_server.port} "
-            f"--testsuite {test_case.suite} --testcase {test_case.name} "
-            "--exitCodeOnFail 44 --reportgen null"
+        command = [
+            squishrunner_path,
+            "--host",
+            squish_server.host,
+            "--port",
+            str(squish_server.port),
+            "--testsuite",
+            str(test_case.suite),
+            "--testcase",
+            test_case.name,
+            *SQUISHRUNNER_OPTIONS,
+        ]
+        logger.info("Execute %s", test_case)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Running command: %s", subprocess.list2cmdline(command))
+        subprocess.run(
+            command,
+            check=True,
+            # Concurrent runners must not compete for the console's stdin
+            stdin=subprocess.DEVNULL,
         )
-        logger.info(f"Execute {test_case}")
-        logger.debug(f"Running command: {command}")
-        subprocess.run(command, shell=True, check=True)
         end_time = time.time()
         execution_time = end_time - start_time
 
@@ -114,62 +162,216 @@ def run_squish_test(
 
         history.update_historical_time(test_case.name, execution_time)
 
-        if e.returncode == 44:
-            logger.debug(f"Test case {test_case} failed on server {squish_server}: {e}")
+        if e.returncode == FAIL_EXIT_CODE:
+            logger.debug(
+                "Test case %s failed on server %s: %s", test_case, squish_server, e
+            )
             return (str(test_case), False, execution_time)
         else:
             logger.error(
-                f"Test case {test_case} encountered an unexpected error on server {squish_server}: \n{e}"
+                "Test case %s encountered an unexpected error on server %s: \n%s",
+                test_case,
+                squish_server,
+                e,
             )
             return (str(test_case), False, execution_time)
 
+    except OSError as e:
+        # Without a shell in between, a missing or non-executable squishrunner
+        # surfaces here instead of as a non-zero exit code.
+        logger.error("Could not start squishrunner for test case %s: %s", test_case, e)
+        return (str(test_case), False, time.time() - start_time)
+
 
 def distribute_tests(
     test_cases: List[TestCase],
     squish_servers: List[SquishServer],
 ) -> Dict[TestCase, Tuple[bool, str, float]]:
-    results = {}
-    test_case_queue = Queue()
-    server_test_counts = {str(server): 0 for server in squish_servers}
-
-    for test_case in test_cases:
-        test_case_queue.put(test_case)
-
-    def worker(server: SquishServer):
-        while not test_case_queue.empty():
+    squishrunner_path = Config().squishrunner_path
+    next_index = itertools.count()
+    next_index_lock = threading.Lock()
+
+    def next_test_case() -> Optional[TestCase]:
+        with next_index_lock:
+            index = next(next_index)
+        return test_cases[index] if index < len(test_cases) else None
+
+    def worker(server: SquishServer) -> Dict[TestCase, Tuple[bool, str, float]]:
+        # Results stay local to the worker and are merged after the join
+        worker_results = {}
+        while True:
+            test_case = next_test_case()
+            if test_case is None:
+                break
             try:
-                test_case = test_case_queue.get_nowait()
-                result = run_squish_test(test_case, server)
-                results[test_case] = [result[1], str(server), result[2]]
-                server_test_counts[str(server)] += 1
-                test_case_queue.task_done()
+                result = run_squish_test(test_case, server, squishrunner_path)
+                worker_results[test_case] = [result[1], str(server), result[2]]
             except Exception as e:
                 logger.error(
-                    f"Error processing test case {test_case} on server {server}: {e}"
+                    "Error processing test case %s on server %s: %s",
+                    test_case,
+                    server,
+                    e,
                 )
-                test_case_queue.task_done()
+        return worker_results
 
     with ThreadPoolExecutor(max_workers=len(squish_servers)) as executor:
         futures = [executor.submit(worker, server) for server in squish_servers]
+        worker_results = {}
         for future in futures:
-            future.result()
+            worker_results.update(future.result())
+
+    # Report results in dispatch order
+    results = {
+        test_case: worker_results[test_case]
+        for test_case in test_cases
+        if test_case in worker_results
+    }
+    server_test_counts = {str(server): 0 for server in squish_servers}
+    for _, server, _ in results.values():
+        server_test_counts[server] += 1
 
     for server, count in server_test_counts.items():
-        logger.info(f"Server {server} executed {count} test cases")
+        logger.info("Server %s executed %d test cases", server, count)
 
     return results
 
 
-def find_test_cases(test_suites_dir: str) -> List[TestCase]:
-    logger.debug(f"Finding test cases in {test_suites_dir}")
+TEST_CASES_CACHE_FILE = ".test_cases_cache.json"
+# Coarsest directory mtime resolution we expect (FAT, SMB and some NFS setups)
+MTIME_RESOLUTION_NS = 2 * 10**9
+
+
+def _scan_test_cases(
+    test_suites_dir: str,
+) -> Tuple[List[TestCase], Optional[Dict[str, int]]]:
+    """
+    Walk the test suites directory for test case directories (``tst_*``).
+
+    The tree is walked with ``os.scandir`` so directory checks use the file
+    type reported by the directory listing instead of a ``stat`` per entry.
+    Test case directories are not descended into; anything named ``tst_*``
+    inside them (e.g. in ``testdata``) is not a test case of its own.
+
+    :param test_suites_dir: Directory containing the Squish test suites.
+    :return: The test cases found and the modification time of every directory
+        that was listed, or None instead of the times if the walk must not be
+        cached.
+    """
+    scan_start_ns = time.time_ns()
     test_cases = []
-    test_cases_path = Path(test_suites_dir)
+    dir_mtimes = {}
+    complete = True
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    pending_dirs = [test_suites_dir]
+
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        suite = None
+        try:
+            # Taken before listing, so changes made later during the walk
+            # still invalidate the cache on the next run
+            dir_mtimes[current_dir] = os.stat(current_dir).st_mtime_ns
+            with os.scandir(current_dir) as entries:
+                for entry in entries:
+                    if entry.name.startswith("tst_"):
+                        if entry.is_dir():
+                            if debug_enabled:
+                                logger.debug("Found test case: %s", entry.path)
+                            if suite is None:
+                                suite = Path(current_dir)
+                            test_cases.append(TestCase(entry.name, suite))
+                    elif entry.is_dir(follow_symlinks=False):
+                        pending_dirs.append(entry.path)
+        except PermissionError:
+            complete = False
+
+    # A directory modified within one mtime tick of the walk may change again
+    # without its mtime moving, which would leave the cache stale for good.
+    # Like git's "racy" index entries, such a walk is not cached; a later run
+    # walks again once the timestamps have settled.
+    racy_after_ns = scan_start_ns - MTIME_RESOLUTION_NS
+    if any(mtime >= racy_after_ns for mtime in dir_mtimes.values()):
+        complete = False
+    return test_cases, dir_mtimes if complete else None
+
+
+def _load_cached_test_cases(
+    test_suites_dir: str, cache_file: str
+) -> Optional[List[TestCase]]:
+    """
+    Load the test cases from the cache if none of the listed directories changed.
+
+    Adding, removing or renaming a test case or suite updates the modification
+    time of its parent directory, so comparing the times of all directories
+    listed by the last walk is enough to detect a changed layout.
+
+    :return: The cached test cases, or None if the cache is missing or stale.
+    """
+    try:
+        with open(cache_file, "rb") as file:
+            cache = _json_loads(file.read())
+        if cache["root"] != os.path.abspath(test_suites_dir):
+            return None
+        for directory, mtime in cache["dir_mtimes"].items():
+            if os.stat(directory).st_mtime_ns != mtime:
+                return None
+        suites: Dict[str, Path] = {}
+        test_cases = []
+        for suite, name in cache["test_cases"]:
+            suite_path = suites.get(suite)
+            if suite_path is None:
+                suite_path = suites[suite] = Path(suite)
+            test_cases.append(TestCase(str(name), suite_path))
+        return test_cases
+    except Exception as e:
+        logger.debug("Not using test case cache %s: %s", cache_file, e)
+        return None
+
+
+def _save_cached_test_cases(
+    test_suites_dir: str,
+    cache_file: str,
+    test_cases: List[TestCase],
+    dir_mtimes: Dict[str, int],
+) -> None:
+    """Store the test cases and directory modification times in the cache."""
+    cache = {
+        "root": os.path.abspath(test_suites_dir),
+        "dir_mtimes": dir_mtimes,
+        "test_cases": [[str(tc.suite), tc.name] for tc in test_cases],
+    }
+    tmp_path = cache_file + ".tmp"
+    try:
+        with open(tmp_path, "wb") as file:
+            file.write(_json_dumps(cache))
+        os.replace(tmp_path, cache_file)
+    except OSError as e:
+        logger.warning("Could not write test case cache %s: %s", cache_file, e)
+
 
-    for test_case_path in test_cases_path.rglob("tst_*"):
-        if test_case_path.is_dir():
-            logger.debug(f"Found test case: {test_case_path}")
-            test_cases.append(TestCase(test_case_path))
-    logger.info(f"Found {len(test_cases)} test cases")
+def find_test_cases(
+    test_suites_dir: str, cache_file: str = TEST_CASES_CACHE_FILE
+) -> List[TestCase]:
+    """
+    Find all test cases below the test suites directory.
+
+    The result of the last walk is reused from ``cache_file`` as long as no
+    directory in the tree has changed since.
+
+    :param test_suites_dir: Directory containing the Squish test suites.
+    :param cache_file: Path of the test case cache.
+    :return: List of TestCase objects found.
+    """
+    logger.debug("Finding test cases in %s", test_suites_dir)
+    test_cases = _load_cached_test_cases(test_suites_dir, cache_file)
+    if test_cases is None:
+        test_cases, dir_mtimes = _scan_test_cases(test_suites_dir)
+        if dir_mtimes is not None:
+            _save_cached_test_cases(test_suites_dir, cache_file, test_cases, dir_mtimes)
+    else:
+        logger.debug("Using cached test cases from %s", cache_file)
+    logger.info("Found %d test cases", len(test_cases))
     return test_cases
 
 
@@ -236,16 +438,38 @@ def parse_args() -> argparse.Namespace:
     return args
 
 
-def sort_test_cases_by_execution_time(test_cases: List[TestCase]) -> List[TestCase]:
+def predict_execution_times(test_cases: List[TestCase]) -> Dict[str, float]:
+    """
+    Predict the execution time of each test case from its history.
+
+    Test cases without any history are predicted to take the average time of
+    all known test cases, so they are neither started first nor left for last.
+
+    :param test_cases: List of TestCase objects to predict.
+    :return: Predicted execution time per test case name.
+    """
+    default_time = history.get_global_average_execution_time()
+    return {
+        tc.name: history.get_average_execution_time(tc.name) or default_time
+        for tc in test_cases
+    }
+
+
+def sort_test_cases_by_execution_time(
+    test_cases: List[TestCase], predicted_times: Optional[Dict[str, float]] = None
+) -> List[TestCase]:
     """
-    Sort test cases by their historical execution time (longest first).
+    Sort test cases by their predicted execution time (longest first).
 
     :param test_cases: List of TestCase objects to sort.
+    :param predicted_times: Result of predict_execution_times, computed if omitted.
     :return: List of TestCase objects sorted by execution time (longest first).
     """
+    if predicted_times is None:
+        predicted_times = predict_execution_times(test_cases)
     return sorted(
         test_cases,
-        key=lambda tc: history.get_average_execution_time(tc.name),
+        key=lambda tc: predicted_times[tc.name],
         reverse=True,  # Sort in descending order (longest first)
     )
 
@@ -253,7 +477,7 @@ def sort_test_cases_by_execution_time(test_cases: List[TestCase]) -> List[TestCa
 def main():
     args = parse_args()
     if args.verbose:
-        logger.setLevel(logger.logging.DEBUG)
+        logger.setLevel(logging.DEBUG)
 
     config = Config(args.config_file)
     squish_servers = config.squishservers
@@ -262,32 +486,45 @@ def main():
         logger.error("No squishservers found in the provided YAML file.")
         sys.exit(1)
 
+    if not config.squishrunner_path:
+        logger.error("No squishrunner_path found in the provided YAML file.")
+        sys.exit(1)
+
+    if shutil.which(config.squishrunner_path) is None:
+        logger.error(
+            "squishrunner_path '%s' is not an executable file.",
+            config.squishrunner_path,
+        )
+        sys.exit(1)
+
     test_cases = find_test_cases(args.test_suites_dir)
     if not test_cases:
         logger.error("No test cases found in the provided directory.")
         sys.exit(1)
     # Sort test cases by execution time (longest first)
-    sorted_test_cases = sort_test_cases_by_execution_time(test_cases)
+    predicted_times = predict_execution_times(test_cases)
+    sorted_test_cases = sort_test_cases_by_execution_time(test_cases, predicted_times)
 
     # Print sorted test cases
     for test_case in sorted_test_cases:
-        avg_time = history.get_average_execution_time(test_case.name)
         logger.info(
-            f"Test Case: {test_case.name}, " f"Average Execution Time: {avg_time:.2f}s"
+            "Test Case: %s, Predicted Execution Time: %.2fs",
+            test_case.name,
+            predicted_times[test_case.name],
         )
-    results = distribute_tests(test_cases, squish_servers)
+    # Dispatch longest first: each server takes the next test as soon as it is
+    # free, which keeps long tests from being left for the end of the run.
+    results = distribute_tests(sorted_test_cases, squish_servers)
     history.save_execution_history()
 
+    pass_label = "\x1b[32;20mPASS\x1b[0m" if USE_COLOR else "PASS"
+    fail_label = "\x1b[31;20mFAIL\x1b[0m" if USE_COLOR else "FAIL"
     logger.info("Test execution results:")
     for test_case, result in results.items():
         if result[0]:
-            logger.info(
-                f"\x1b[32;20mPASS\x1b[0m {result[1]} {test_case} ({result[2]:.2f}s)"
-            )
+            logger.info("%s %s %s (%.2fs)", pass_label, result[1], test_case, result[2])
         else:
-            logger.info(
-                f"\x1b[31;20mFAIL\x1b[0m {result[1]} {test_case} ({result[2]:.2f}s)"
-            )
+            logger.info("%s %s %s (%.2fs)", fail_label, result[1], test_case, result[2])
 
 
 if __name__ == "__main__":